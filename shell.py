@@ -1,44 +1,112 @@
 #!/usr/bin/env python3
 import os
+import sys
 import shutil
 import subprocess
 import re
 import readline
 import getpass
 import socket
+import functools
 import shlex
 from typing import List, Optional
 from colorama import init, Fore, Style
 
-init(autoreset=True)
+# Wrapping stdout is only needed to translate ANSI codes on Windows and to
+# strip them from redirected output; a POSIX terminal takes them as-is.
+if os.name == 'nt' or not sys.stdout.isatty():
+    init(autoreset=True)
 
-HISTFILE = os.path.expanduser("~/.shistory")
+_HOME = os.path.expanduser("~")
+# Same trailing-separator handling as os.path.expanduser, so HOME=/ expands
+# "~/etc" to "/etc" rather than "//etc".
+_HOME_PREFIX = _HOME.rstrip(os.sep)
+
+HISTFILE = os.path.join(_HOME, ".shistory")
 HISTORY_LIMIT = 1000
+HISTORY_TAIL_BYTES = HISTORY_LIMIT * 256
+# libedit writes a header line and escapes entries, so only GNU readline's
+# history file can be fed to add_history line by line.
+_READLINE_IS_GNU = 'libedit' not in (readline.__doc__ or '')
+WHICH_CACHE_SIZE = 512
+
+_USER = getpass.getuser()
+_HOST = socket.gethostname().split('.')[0]
 
 user_vars = {}
+_history_loaded = False
+_cached_prompt = ""
+_which_cache = {}
+
+_VAR_RE = re.compile(r'\$(\w+)')
+_CHAIN_OPS = frozenset(('&&', '||', ';'))
+
+def _expanduser(path: str) -> str:
+    if path == "~":
+        return _HOME
+    if path.startswith("~/"):
+        return _HOME_PREFIX + path[1:]
+    if path.startswith("~"):
+        return os.path.expanduser(path)
+    return path
+
+def cprint(text: str) -> None:
+    print(text + Style.RESET_ALL)
+
+def _trim_history() -> None:
+    length = readline.get_current_history_length()
+    if length <= HISTORY_LIMIT:
+        return
+    keep = [readline.get_history_item(i)
+            for i in range(length - HISTORY_LIMIT + 1, length + 1)]
+    readline.clear_history()
+    for item in keep:
+        readline.add_history(item)
 
 def load_history() -> None:
+    global _history_loaded
+    _history_loaded = True
+    readline.set_history_length(HISTORY_LIMIT)
     try:
-        readline.read_history_file(HISTFILE)
-        readline.set_history_length(HISTORY_LIMIT)
-    except FileNotFoundError:
-        pass
+        size = os.stat(HISTFILE).st_size
+        if size <= HISTORY_TAIL_BYTES or not _READLINE_IS_GNU:
+            readline.read_history_file(HISTFILE)
+            _trim_history()
+            return
+
+        # Only the tail of a large file can hold the entries we keep, so
+        # read just that and skip handing the whole file to readline.
+        with open(HISTFILE, 'rb') as f:
+            f.seek(size - HISTORY_TAIL_BYTES)
+            f.readline()
+            tail = f.read()
+    except OSError:
+        return
+    lines = tail.decode(errors='surrogateescape').splitlines()
+    for line in lines[-HISTORY_LIMIT:]:
+        readline.add_history(line)
 
 def save_history() -> None:
+    if not _history_loaded:
+        return
     try:
         readline.write_history_file(HISTFILE)
     except Exception:
         pass
 
+def _replace_var(match, _uv=user_vars, _env=os.environ) -> str:
+    name = match.group(1)
+    return _uv.get(name) or _env.get(name, "")
+
 def expand_vars(command: str) -> str:
-    pattern = re.compile(r'\$(\w+)')
-    def replace_var(match):
-        name = match.group(1)
-        return user_vars.get(name) or os.environ.get(name, "")
-    return pattern.sub(replace_var, command)
+    if '$' not in command:
+        return command
+    return _VAR_RE.sub(_replace_var, command)
 
 def assign_variable(line: str) -> bool:
-    if '=' not in line or line.strip().startswith('export '):
+    if '=' not in line:
+        return False
+    if line.startswith('export '):
         return False
     var, _, val = line.partition('=')
     var = var.strip()
@@ -55,7 +123,7 @@ def internal_help(args: List[str]) -> int:
     help_text += "\n\nAliases:\n - ld (ls)\n - e (echo)"
     help_text += "\n\nSupports variable expansion ($VAR), assignments VAR=val, "
     help_text += "command chaining with ';', '&&', and pipes '|'"
-    print(help_text)
+    cprint(help_text)
     return 0
 
 def internal_exit(args: List[str]) -> int:
@@ -63,13 +131,17 @@ def internal_exit(args: List[str]) -> int:
     raise SystemExit
 
 def internal_clear(args: List[str]) -> int:
-    os.system('cls' if os.name == 'nt' else 'clear')
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        sys.stdout.write('\x1b[H\x1b[2J')
+        sys.stdout.flush()
     return 0
 
 def internal_env(args: List[str]) -> int:
     merged = {**os.environ, **user_vars}
-    for k, v in merged.items():
-        print(f"{k}={v}")
+    if merged:
+        sys.stdout.write("\n".join(f"{k}={v}" for k, v in merged.items()) + "\n")
     return 0
 
 def internal_set(args: List[str]) -> int:
@@ -77,71 +149,116 @@ def internal_set(args: List[str]) -> int:
         user_vars[args[0]] = " ".join(args[1:])
     return 0
 
-internal_commands = {
-    "help": internal_help,
-    "exit": internal_exit,
-    "clear": internal_clear,
-    "env": internal_env,
-    "set": internal_set,
-    "cd": internal_cd,
-    "ld": internal_ls,
-    "e": internal_echo,
-}
-
 def internal_cd(args: List[str]) -> int:
     if not args:
-        path = os.path.expanduser("~")
+        path = _HOME
     elif len(args) == 1:
         path = args[0]
     else:
-        print(Fore.RED + "cd: too many arguments")
+        cprint(Fore.RED + "cd: too many arguments")
         return 1
 
     try:
-        os.chdir(os.path.expanduser(path))
+        os.chdir(_expanduser(path))
+        refresh_prompt()
         return 0
     except FileNotFoundError:
-        print(Fore.RED + f"cd: no such file or directory: {path}")
+        cprint(Fore.RED + f"cd: no such file or directory: {path}")
         return 1
     except Exception as e:
-        print(Fore.RED + f"cd: {e}")
+        cprint(Fore.RED + f"cd: {e}")
         return 1
 
 def internal_ls(args: List[str]) -> int:
     path = args[0] if args else "."
     try:
-        for entry in os.listdir(os.path.expanduser(path)):
-            print(entry)
+        with os.scandir(_expanduser(path)) as it:
+            entries = [entry.name for entry in it]
+        if entries:
+            sys.stdout.write("\n".join(entries) + "\n")
         return 0
     except FileNotFoundError:
-        print(Fore.RED + f"ls: cannot access '{path}': No such file or directory")
+        cprint(Fore.RED + f"ls: cannot access '{path}': No such file or directory")
         return 1
     except Exception as e:
-        print(Fore.RED + f"ls: {e}")
+        cprint(Fore.RED + f"ls: {e}")
         return 1
 
 def internal_echo(args: List[str]) -> int:
     print(" ".join(args))
     return 0
 
+internal_commands = {
+    "help": internal_help,
+    "exit": internal_exit,
+    "clear": internal_clear,
+    "env": internal_env,
+    "set": internal_set,
+    "cd": internal_cd,
+    "ld": internal_ls,
+    "e": internal_echo,
+}
+
+_INTERNAL_NAMES = frozenset(internal_commands)
+
+@functools.lru_cache(maxsize=8)
+def _path_is_absolute(path: str) -> bool:
+    return all(os.path.isabs(d) for d in path.split(os.pathsep))
+
+def find_executable(cmd: str) -> Optional[str]:
+    if os.sep in cmd:
+        return shutil.which(cmd)
+    path = os.environ.get('PATH', os.defpath)
+    # Relative PATH entries resolve against the cwd, so their hits go stale
+    # after a cd.
+    if not _path_is_absolute(path):
+        return shutil.which(cmd, path=path)
+
+    key = (cmd, path)
+    cached = _which_cache.get(key)
+    if cached is not None and os.path.isfile(cached):
+        return cached
+
+    # Misses are not cached so a newly installed command is picked up.
+    found = shutil.which(cmd, path=path)
+    if found is None:
+        _which_cache.pop(key, None)
+    else:
+        if len(_which_cache) >= WHICH_CACHE_SIZE:
+            _which_cache.clear()
+        _which_cache[key] = found
+    return found
+
+def split_args(line: str) -> List[str]:
+    if '|' in line or '&' in line or ';' in line:
+        # Operators become their own tokens even without surrounding
+        # whitespace; quoted ones stay part of the word.
+        lexer = shlex.shlex(line, posix=True, punctuation_chars='|&;')
+        lexer.whitespace_split = True
+        lexer.commenters = ''
+        return list(lexer)
+    if '"' in line or "'" in line or '\\' in line:
+        return shlex.split(line, posix=True)
+    return line.split()
+
 def execute_internal(cmd: str, args: List[str]) -> int:
     try:
         return internal_commands[cmd](args)
     except SystemExit:
         raise
     except Exception as e:
-        print(Fore.RED + f"Error in internal command '{cmd}': {e}")
+        cprint(Fore.RED + f"Error in internal command '{cmd}': {e}")
         return 1
 
 def execute_external(cmd: str, args: List[str], stdin=None, stdout=None) -> int:
     try:
         proc = subprocess.Popen(
-            [cmd] + args, stdin=stdin, stdout=stdout
+            [cmd] + args, stdin=stdin, stdout=stdout, close_fds=False
         )
         proc.wait()
         return proc.returncode
     except Exception as e:
-        print(Fore.RED + f"Error executing '{cmd}': {e}")
+        cprint(Fore.RED + f"Error executing '{cmd}': {e}")
         return 1
 
 def run_command(line: str, stdin=None, stdout=None) -> int:
@@ -157,136 +274,149 @@ def run_command(line: str, stdin=None, stdout=None) -> int:
         return 0
     cmd, args = parts[0], parts[1:]
 
-    if cmd in internal_commands:
+    if cmd in _INTERNAL_NAMES:
         return execute_internal(cmd, args)
 
-    path = shutil.which(cmd)
+    path = find_executable(cmd)
     if path:
         return execute_external(path, args, stdin=stdin, stdout=stdout)
 
-    print(Fore.RED + Style.BRIGHT +
-          f"Command not found: '{cmd}'")
+    cprint(Fore.RED + Style.BRIGHT +
+           f"Command not found: '{cmd}'")
     return 127
 
-def run_pipeline(line: str) -> int:
-    commands = [cmd.strip() for cmd in line.split('|')]
-    if not commands:
-        return 0
+def _abort_pipeline(procs: List[subprocess.Popen]) -> None:
+    if procs and procs[-1].stdout:
+        procs[-1].stdout.close()
+    for p in procs:
+        p.kill()
+        p.wait()
+
+def run_pipeline(tokens: List[str]) -> int:
+    stages = [[]]
+    for token in tokens:
+        if token == '|':
+            stages.append([])
+        else:
+            stages[-1].append(token)
 
     procs = []
-    prev_stdout = None
-
-    for i, cmd in enumerate(commands):
-        first_word = cmd.split()[0] if cmd else ""
-        if first_word in internal_commands:
-            print(Fore.RED + "Internal commands cannot be used in pipelines.")
-            for p in procs:
-                p.kill()
+    last = len(stages) - 1
+
+    for i, stage in enumerate(stages):
+        argv = [w for arg in stage for w in expand_vars(arg).split()]
+        if not argv:
+            cprint(Fore.RED + "Pipeline syntax error: empty command")
+            _abort_pipeline(procs)
+            return 1
+        if argv[0] in _INTERNAL_NAMES:
+            cprint(Fore.RED + "Internal commands cannot be used in pipelines.")
+            _abort_pipeline(procs)
             return 1
 
-        stdin = prev_stdout
-        stdout = subprocess.PIPE if i < len(commands) - 1 else None
+        path = find_executable(argv[0])
+        if not path:
+            cprint(Fore.RED + Style.BRIGHT +
+                   f"Command not found: '{argv[0]}'")
+            _abort_pipeline(procs)
+            return 127
 
         try:
             proc = subprocess.Popen(
-                cmd, shell=True, stdin=stdin, stdout=stdout
+                [path] + argv[1:],
+                stdin=procs[-1].stdout if procs else None,
+                stdout=subprocess.PIPE if i < last else None,
+                close_fds=False
             )
         except Exception as e:
-            print(Fore.RED + f"Pipeline execution failed: {e}")
-            for p in procs:
-                p.kill()
+            cprint(Fore.RED + f"Pipeline execution failed: {e}")
+            _abort_pipeline(procs)
             return 1
 
-        if prev_stdout:
-            prev_stdout.close()
-        prev_stdout = proc.stdout
+        # Only the child should hold the read end, so an early exit
+        # downstream delivers SIGPIPE to the writer.
+        if procs:
+            procs[-1].stdout.close()
         procs.append(proc)
 
-    retcodes = []
-    for p in procs:
+    for p in reversed(procs):
         p.wait()
-        retcodes.append(p.returncode)
 
-    return retcodes[-1] if retcodes else 0
+    return procs[-1].returncode
+
+def run_segment(tokens: List[str]) -> int:
+    if '|' in tokens:
+        return run_pipeline(tokens)
+    return run_command(' '.join(tokens))
 
 def execute_line(line: str) -> None:
-    tokens = shlex.split(line, posix=True)
+    tokens = split_args(line)
     if not tokens:
         return
 
-    segments = []
-    current = []
-    operators = []
-
-    i = 0
-    while i < len(tokens):
-        token = tokens[i]
-        if token in ['&&', '||', ';']:
-            segments.append(' '.join(current))
-            current = []
-            operators.append(token)
-        else:
-            current.append(token)
-        i += 1
-    if current:
-        segments.append(' '.join(current))
-
-    assert len(segments) >= 1
+    if ';' not in line and '&' not in line and '|' not in line:
+        run_command(' '.join(tokens))
+        return
 
     proceed = True
     last_code = 0
+    current = []
 
-    for idx, segment in enumerate(segments):
-        if idx > 0:
-            op = operators[idx - 1]
-            if op == '&&' and last_code != 0:
-                proceed = False
-            elif op == '||' and last_code == 0:
-                proceed = False
-            else:
-                proceed = True
-
-        if not proceed:
+    for token in tokens:
+        if token not in _CHAIN_OPS:
+            current.append(token)
             continue
 
-        if '|' in segment:
-            last_code = run_pipeline(segment)
+        if proceed:
+            last_code = run_segment(current)
+        current = []
+
+        if token == '&&' and last_code != 0:
+            proceed = False
+        elif token == '||' and last_code == 0:
+            proceed = False
         else:
-            last_code = run_command(segment)
+            proceed = True
+
+    if current and proceed:
+        run_segment(current)
 
 def shorten_cwd(path: str) -> str:
-    home = os.path.expanduser("~")
-    if path == home:
+    if path == _HOME:
         return "~"
-    if path.startswith(home + os.sep):
-        return "~" + path[len(home):]
+    if path.startswith(_HOME + os.sep):
+        return "~" + path[len(_HOME):]
     return os.path.basename(path) or "/"
 
 def prompt() -> str:
-    user = getpass.getuser()
-    host = socket.gethostname().split('.')[0]
     cwd = shorten_cwd(os.getcwd())
-    return f"{Fore.BLUE}{user}@{host}:{cwd} >>> {Style.RESET_ALL}"
+    return f"{Fore.BLUE}{_USER}@{_HOST}:{cwd} >>> {Style.RESET_ALL}"
+
+def refresh_prompt() -> None:
+    global _cached_prompt
+    _cached_prompt = prompt()
 
 def main() -> None:
-    load_history()
-    print(Fore.GREEN + "TrashShell v1.5 - "
-          "type 'help' for commands")
+    if sys.stdin.isatty():
+        load_history()
+    refresh_prompt()
+    cprint(Fore.GREEN + "TrashShell v1.5 - "
+           "type 'help' for commands")
 
     try:
         while True:
             try:
-                line = input(prompt())
+                line = input(_cached_prompt)
                 execute_line(line)
             except KeyboardInterrupt:
-                print(Fore.YELLOW + "\n(To exit, type 'exit')")
+                cprint(Fore.YELLOW + "\n(To exit, type 'exit')")
             except EOFError:
                 print("\nGoodbye.")
                 break
             except SystemExit:
                 break
             except Exception as e:
-                print(Fore.RED + f"Unexpected error: {e}")
+                cprint(Fore.RED + f"Unexpected error: {e}")
     finally:
         save_history()
 